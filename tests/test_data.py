@@ -7,11 +7,33 @@ Description: Test some functions for dataset
 FilePath: /torchhydro/tests/test_data.py
 Copyright (c) 2023-2024 Wenyu Ouyang. All rights reserved.
 """
+import pickle as pkl
+
+import numpy as np
+import pandas as pd
 import pytest
+import torch
+import xarray as xr
 import hydrodataset as hds
+from hydroutils.hydro_stat import cal_stat, cal_stat_gamma, cal_stat_prcp_norm
+from sklearn.preprocessing import StandardScaler
 from torch.utils.data import Dataset
 
-from torchhydro.datasets.data_sets import KuaiSampler
+from torchhydro.datasets.data_scalers import (
+    SCALER_DICT,
+    DapengScaler,
+    _cal_stat_group,
+    _fit_or_transform,
+    _load_scaler,
+    _save_scaler,
+    _scaler_affine,
+)
+from torchhydro.datasets.data_utils import (
+    _prcp_norm,
+    _trans_norm,
+    unify_streamflow_unit,
+)
+from torchhydro.datasets.data_sets import BaseDataset, KuaiSampler, _fill_gaps_da
 
 
 class SimpleDataset(Dataset):
@@ -44,6 +66,14 @@ def test_sampler_length(sampler):
     assert len(sampler) == num_samples, f"Expected {num_samples} but got {len(sampler)}"
 
 
+def test_sampler_batch_size_shrink(dataset):
+    # 100 * 20 >= 2 * 60, so batch_size is cut to the largest one keeping batch_size * rho < ngrid * nt
+    sampler = KuaiSampler(
+        dataset, batch_size=100, warmup_length=0, rho=20, ngrid=2, nt=60
+    )
+    assert len(sampler) == 15
+
+
 def test_sampler_within_range(sampler, dataset):
     for idx in sampler:
         assert 0 <= idx < len(dataset), f"Index {idx} out of bounds"
@@ -66,3 +96,407 @@ def test_cache_file():
     """
     camels_us = hds.Camels()
     camels_us.cache_xrdataset()
+
+
+def test_cal_stat_group():
+    """_cal_stat_group should give the same statistics as hydroutils' per-variable functions"""
+    rng = np.random.default_rng(0)
+    x = rng.gamma(2.0, 3.0, size=(4, 3, 50)).astype(np.float32)
+    x[0, :, ::7] = np.nan
+    x[1, 0, :] = np.nan
+    # a variable without any valid value
+    x[3] = np.nan
+    mean_prcp = rng.uniform(1.0, 5.0, size=(3, 1))
+    gamma_mask = np.array([True, True, False, False])
+    # the 2nd variable is a prcp_norm_cols one, which is divided by mean precipitation first
+    x_prcp_norm = x.copy()
+    x_prcp_norm[1] = x_prcp_norm[1] / mean_prcp
+    stat_arr = _cal_stat_group(x_prcp_norm.reshape(4, -1), gamma_mask)
+    expected = [
+        cal_stat_gamma(x[0]),
+        cal_stat_prcp_norm(x[1], mean_prcp),
+        cal_stat(x[2]),
+        cal_stat(x[3]),
+    ]
+    np.testing.assert_allclose(stat_arr, np.array(expected), rtol=1e-5)
+
+
+@pytest.fixture
+def norm_data():
+    rng = np.random.default_rng(1)
+    values = rng.gamma(2.0, 3.0, size=(3, 4, 30))
+    values[0, 1, ::5] = np.nan
+    data = xr.DataArray(
+        values,
+        dims=("variable", "basin", "time"),
+        coords={"variable": ["prcp", "temp", "streamflow"]},
+    )
+    # [p10, p90, mean, std] for each variable
+    stat_dict = {
+        "prcp": [0.0, 0.0, 0.5, 0.3],
+        "temp": [0.0, 0.0, 6.0, 4.0],
+        "streamflow": [0.0, 0.0, 0.2, 0.4],
+    }
+    return data, stat_dict
+
+
+def test_trans_norm(norm_data):
+    """the numba kernels of _trans_norm should give the same results as plain numpy formulas"""
+    data, stat_dict = norm_data
+    var_lst = ["streamflow", "prcp", "temp"]
+    log_norm_cols = ["prcp", "streamflow"]
+    data_norm = _trans_norm(data, var_lst, stat_dict, log_norm_cols=log_norm_cols)
+    assert data_norm.dims == data.dims
+    for var in var_lst:
+        x = data.sel(variable=var).to_numpy()
+        if var in log_norm_cols:
+            x = np.log10(np.sqrt(x) + 0.1)
+        expected = (x - stat_dict[var][2]) / stat_dict[var][3]
+        np.testing.assert_allclose(
+            data_norm.sel(variable=var).to_numpy(), expected, rtol=1e-5, atol=1e-6
+        )
+    data_denorm = _trans_norm(
+        data_norm, var_lst, stat_dict, log_norm_cols=log_norm_cols, to_norm=False
+    )
+    np.testing.assert_allclose(
+        data_denorm.sel(variable=data["variable"]).to_numpy(),
+        data.to_numpy(),
+        rtol=1e-4,
+    )
+
+
+def test_trans_norm_dask(norm_data):
+    """dask-backed data should be normalized lazily, block by block, with the same results"""
+    data, stat_dict = norm_data
+    var_lst = ["streamflow", "prcp", "temp"]
+    log_norm_cols = ["prcp", "streamflow"]
+    expected = _trans_norm(data, var_lst, stat_dict, log_norm_cols=log_norm_cols)
+    data_chunked = data.chunk({"variable": 1, "basin": 2, "time": 10})
+    data_norm = _trans_norm(
+        data_chunked, var_lst, stat_dict, log_norm_cols=log_norm_cols
+    )
+    assert data_norm.chunks is not None
+    assert data_norm.dims == data.dims
+    np.testing.assert_array_equal(data_norm.to_numpy(), expected.to_numpy())
+
+
+@pytest.mark.parametrize("scaler_type", list(SCALER_DICT.keys()))
+def test_scaler_affine(scaler_type, tmp_path):
+    """(x - center) / scale from saved parameters should be same as sklearn's transform"""
+    rng = np.random.default_rng(2)
+    data = rng.normal(3.0, 2.0, size=(200, 3))
+    scaler = SCALER_DICT[scaler_type]().fit(data)
+    expected = scaler.transform(data)
+    save_file = str(tmp_path / "target_vars_scaler.npz")
+    _save_scaler(scaler, save_file)
+    center, scale = _scaler_affine(scaler_type, vars(scaler))
+    np.testing.assert_allclose((data - center) / scale, expected)
+    with np.load(save_file) as params:
+        center, scale = _scaler_affine(scaler_type, params)
+    np.testing.assert_allclose((data - center) / scale, expected)
+    scaler_loaded = _load_scaler(scaler_type, save_file)
+    np.testing.assert_allclose(scaler_loaded.transform(data), expected)
+
+
+def test_legacy_pickled_scaler(tmp_path):
+    """pickled scalers of older versions are used only if they have one feature for each variable"""
+    rng = np.random.default_rng(5)
+    data = xr.DataArray(
+        rng.normal(3.0, 2.0, size=(2, 4, 30)),
+        dims=("variable", "basin", "time"),
+        coords={"variable": ["prcp", "temp"]},
+    )
+    data_params = {"test_path": str(tmp_path), "stat_dict_file": None}
+    values = data.transpose(..., "variable").to_numpy()
+    scaler = StandardScaler().fit(values.reshape(-1, 2))
+    with open(tmp_path / "relevant_vars_scaler.pkl", "wb") as outfile:
+        pkl.dump(scaler, outfile)
+    data_norm, _ = _fit_or_transform(
+        data, "relevant_vars", "StandardScaler", data_params, "test"
+    )
+    expected = scaler.transform(values.reshape(-1, 2)).reshape(values.shape)
+    np.testing.assert_allclose(
+        data_norm.transpose(..., "variable").to_numpy(), expected, rtol=1e-5, atol=1e-6
+    )
+    # older versions fitted (variable, basin, time) data reshaped to (-1, time)
+    scaler = StandardScaler().fit(data.to_numpy().reshape(-1, 30))
+    with open(tmp_path / "relevant_vars_scaler.pkl", "wb") as outfile:
+        pkl.dump(scaler, outfile)
+    with pytest.raises(ValueError, match="30 features"):
+        _fit_or_transform(data, "relevant_vars", "StandardScaler", data_params, "test")
+
+
+def test_trans_norm_fused_prcp_norm(norm_data):
+    """denormalization with fused prcp_norm should equal _trans_norm followed by _prcp_norm"""
+    data, stat_dict = norm_data
+    var_lst = ["streamflow", "prcp"]
+    log_norm_cols = ["prcp", "streamflow"]
+    mean_prep = np.random.default_rng(3).uniform(1.0, 5.0, size=(4, 1))
+    data_norm = _trans_norm(data, var_lst, stat_dict, log_norm_cols=log_norm_cols)
+    denorm = _trans_norm(
+        data_norm, var_lst, stat_dict, log_norm_cols=log_norm_cols, to_norm=False
+    )
+    expected = denorm.sel(variable=var_lst).to_numpy()
+    expected[0] = _prcp_norm(expected[0], mean_prep, to_norm=False)
+    fused = _trans_norm(
+        data_norm,
+        var_lst,
+        stat_dict,
+        log_norm_cols=log_norm_cols,
+        to_norm=False,
+        prcp_norm_cols=["streamflow"],
+        mean_prep=mean_prep,
+    )
+    np.testing.assert_allclose(
+        fused.sel(variable=var_lst).to_numpy(), expected, rtol=1e-5
+    )
+    with pytest.raises(ValueError):
+        _trans_norm(
+            data,
+            var_lst,
+            stat_dict,
+            log_norm_cols=log_norm_cols,
+            prcp_norm_cols=["streamflow"],
+            mean_prep=mean_prep,
+        )
+
+
+@pytest.fixture
+def gap_data():
+    """(variable, basin, time) data linear in time, so interpolation recovers the true values"""
+    time = pd.date_range("2000-01-01", periods=8)
+    truth = (
+        10.0 * np.arange(2)[:, None, None]
+        + np.arange(3)[None, :, None]
+        + np.arange(8)[None, None, :]
+    )
+    values = truth.copy()
+    values[0, 0, 2] = np.nan
+    values[1, 2, 0] = np.nan
+    values[1, 1, 7] = np.nan
+    # a date without any value
+    values[:, :, 5] = np.nan
+    data = xr.DataArray(
+        values,
+        dims=("variable", "basin", "time"),
+        coords={"variable": ["prcp", "ssm"], "basin": ["01", "02", "03"], "time": time},
+    )
+    return data, truth
+
+
+@pytest.mark.parametrize("fill_nan", ["interpolate", "et_ssm_ignore"])
+def test_fill_gaps_da_time(gap_data, fill_nan):
+    data, truth = gap_data
+    data_before = data.copy(deep=True)
+    filled = _fill_gaps_da(data, fill_nan=fill_nan)
+    xr.testing.assert_identical(data, data_before)
+    assert filled.dims == data.dims
+    expected = truth.copy()
+    if fill_nan == "et_ssm_ignore":
+        # dates without any value in all basins are ignored
+        expected[:, :, 5] = np.nan
+    np.testing.assert_allclose(filled.to_numpy(), expected)
+
+
+def test_fill_gaps_da_mean():
+    values = np.array([[1.0, np.nan, 3.0], [np.nan, 4.0, 8.0]])
+    data = xr.DataArray(
+        values,
+        dims=("variable", "basin"),
+        coords={"variable": ["area", "slope"], "basin": ["01", "02", "03"]},
+    )
+    data_before = data.copy(deep=True)
+    filled = _fill_gaps_da(data, fill_nan="mean")
+    xr.testing.assert_identical(data, data_before)
+    # NaN of each variable is filled with its mean across basins
+    np.testing.assert_allclose(filled.to_numpy(), [[1.0, 2.0, 3.0], [6.0, 4.0, 8.0]])
+
+
+class _StubSource:
+    """a data source only giving basins' area and mean precipitation"""
+
+    def __init__(self, basins, area, mean_prcp):
+        self.basins = basins
+        self.area = area
+        self.mean_prcp = mean_prcp
+
+    def read_area(self, basins):
+        return xr.Dataset(
+            {"area": ("basin", self.area, {"units": "km^2"})},
+            coords={"basin": self.basins},
+        ).sel(basin=basins)
+
+    def read_mean_prcp(self, basins):
+        return xr.Dataset(
+            {"p_mean": ("basin", self.mean_prcp, {"units": "mm/d"})},
+            coords={"basin": self.basins},
+        ).sel(basin=basins)
+
+
+@pytest.mark.parametrize("prcp_norm_cols", [["streamflow"], []])
+def test_inverse_transform_same_as_pint(prcp_norm_cols, tmp_path):
+    """precomputed streamflow factors should give the same results as pint's unit conversion"""
+    rng = np.random.default_rng(6)
+    basins = ["01", "02", "03"]
+    time = pd.date_range("2000-01-01", periods=40)
+
+    def _da(n_var, var_lst, units):
+        return xr.DataArray(
+            rng.gamma(2.0, 1.5, size=(n_var, len(basins), len(time))),
+            dims=("variable", "basin", "time"),
+            coords={"variable": var_lst, "basin": basins, "time": time},
+            attrs={"units": units},
+        )
+
+    target = _da(1, ["streamflow"], {"streamflow": "mm/d"})
+    forcing = _da(1, ["prcp"], {"prcp": "mm/d"})
+    attr = xr.DataArray(
+        rng.random((1, len(basins))),
+        dims=("variable", "basin"),
+        coords={"variable": ["area"], "basin": basins},
+    )
+    data_source = _StubSource(
+        basins,
+        rng.uniform(50.0, 500.0, len(basins)),
+        rng.uniform(1.0, 5.0, len(basins)),
+    )
+    data_params = {
+        "object_ids": basins,
+        "t_range_train": ["2000-01-01", "2000-02-10"],
+        "target_cols": ["streamflow"],
+        "relevant_cols": ["prcp"],
+        "constant_cols": ["area"],
+        "test_path": str(tmp_path),
+        "stat_dict_file": None,
+    }
+    scaler = DapengScaler(
+        target,
+        forcing,
+        attr,
+        data_params,
+        "train",
+        data_source,
+        prcp_norm_cols=prcp_norm_cols,
+    )
+    target_norm = scaler.get_data_obs()
+    pred = scaler.inverse_transform(target_norm)
+    # the way before the factors were precomputed
+    expected = _trans_norm(
+        target_norm,
+        ["streamflow"],
+        scaler.stat_dict,
+        log_norm_cols=scaler.log_norm_cols,
+        to_norm=False,
+    )
+    if prcp_norm_cols:
+        mean_prcp = data_source.read_mean_prcp(basins).to_array().to_numpy().T
+        expected.loc[dict(variable="streamflow")] = _prcp_norm(
+            expected.sel(variable="streamflow").to_numpy(), mean_prcp, to_norm=False
+        )
+    expected.attrs.update(scaler.data_target.attrs)
+    expected_ds = expected.to_dataset(dim="variable")
+    expected_ds = unify_streamflow_unit(
+        expected_ds.pint.quantify(expected_ds.attrs["units"]),
+        area=data_source.read_area(basins),
+        inverse=True,
+    )
+    assert pred["streamflow"].attrs["units"] == "m^3/s"
+    np.testing.assert_allclose(
+        pred["streamflow"].transpose("basin", "time").to_numpy(),
+        expected_ds["streamflow"].transpose("basin", "time").to_numpy(),
+        rtol=1e-5,
+    )
+
+
+def _array_dataset(x, y, c, rho, warmup_length):
+    """a training BaseDataset holding given basin-first normalized arrays, without reading any data source"""
+    coords = {
+        "basin": [f"{i:02d}" for i in range(y.shape[0])],
+        "time": pd.date_range("2000-01-01", periods=y.shape[1]),
+    }
+    dims = ("basin", "time", "variable")
+    if c is not None:
+        c = xr.DataArray(
+            c, dims=("basin", "variable"), coords={"basin": coords["basin"]}
+        )
+    dataset = BaseDataset.__new__(BaseDataset)
+    dataset.train_mode = True
+    dataset.rho = rho
+    dataset.warmup_length = warmup_length
+    dataset._set_arrays(
+        xr.DataArray(x, dims=dims, coords=coords),
+        xr.DataArray(y, dims=dims, coords=coords),
+        c,
+    )
+    return dataset
+
+
+@pytest.mark.parametrize("with_attr", [True, False])
+def test_getitems_same_as_getitem(with_attr):
+    rng = np.random.default_rng(4)
+    x = rng.random((3, 40, 2), dtype=np.float32)
+    y = rng.random((3, 40, 1), dtype=np.float32)
+    c = rng.random((3, 4), dtype=np.float32) if with_attr else None
+    dataset = _array_dataset(x, y, c, rho=10, warmup_length=3)
+    indices = [0, 5, 40, len(dataset) - 1, 17]
+    batch = dataset.__getitems__(indices)
+    assert len(batch) == len(indices)
+    for (xc, ys), idx in zip(batch, indices):
+        xc_expected, ys_expected = dataset[idx]
+        assert xc.shape == (13, 6 if with_attr else 2)
+        basin_idx = dataset.lookup_basin_idx[idx]
+        time_idx = dataset.lookup_time_idx[idx]
+        np.testing.assert_array_equal(
+            xc[:, :2].numpy(), x[basin_idx, time_idx - 3 : time_idx + 10]
+        )
+        if with_attr:
+            np.testing.assert_array_equal(
+                xc[:, 2:].numpy(), np.tile(c[basin_idx], (13, 1))
+            )
+        torch.testing.assert_close(xc, xc_expected)
+        torch.testing.assert_close(ys, ys_expected)
+
+
+def test_set_arrays_checks_coords():
+    """x and c are indexed by the positions of y, so their coords must be the same as y's"""
+    time = pd.date_range("2000-01-01", periods=20)
+    y = xr.DataArray(
+        np.ones((1, 3, 20)),
+        dims=("variable", "basin", "time"),
+        coords={"basin": ["01", "02", "03"], "time": time},
+    )
+    dataset = BaseDataset.__new__(BaseDataset)
+    dataset.train_mode = True
+    dataset.rho = 5
+    dataset.warmup_length = 0
+    with pytest.raises(AssertionError, match="basin"):
+        dataset._set_arrays(y.isel(basin=[1, 0, 2]), y, None)
+    with pytest.raises(AssertionError, match="time"):
+        dataset._set_arrays(y.assign_coords(time=time + pd.Timedelta("1D")), y, None)
+    c = xr.DataArray(
+        np.ones((2, 3)),
+        dims=("variable", "basin"),
+        coords={"basin": ["01", "03", "02"]},
+    )
+    with pytest.raises(AssertionError, match="basin"):
+        dataset._set_arrays(y, y, c)
+
+
+def test_lookup_table_skips_all_nan_windows():
+    rho, warmup_length, time_length = 5, 2, 20
+    x = np.zeros((3, time_length, 1), dtype=np.float32)
+    y = np.ones((3, time_length, 2), dtype=np.float32)
+    # basin 1 has targets only in its last 6 steps, basin 2 has no target at all
+    y[1, :-6] = np.nan
+    y[2] = np.nan
+    # one of two targets is enough for a valid time step
+    y[0, 10, 0] = np.nan
+    dataset = _array_dataset(x, y, None, rho=rho, warmup_length=warmup_length)
+    starts = list(range(warmup_length, time_length - rho + 1))
+    # windows of basin 1 need to reach its valid steps from time_length - 6 on
+    starts_1 = [t for t in starts if t + rho > time_length - 6]
+    np.testing.assert_array_equal(
+        dataset.lookup_basin_idx, [0] * len(starts) + [1] * len(starts_1)
+    )
+    np.testing.assert_array_equal(dataset.lookup_time_idx, starts + starts_1)
+    assert len(dataset) == len(starts) + len(starts_1)
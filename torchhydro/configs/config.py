@@ -110,6 +110,10 @@ def default_config_file():
                 "vp",
             ],
             "relevant_rm_nan": True,
+            # chunks (such as {"basin": 100}) for the time series input; if not None, it is read lazily by dask,
+            # DapengScaler computes its statistics variable by variable and normalizes it chunk by chunk,
+            # so it is only loaded when the normalized array is built
+            "relevant_chunks": None,
             # the attribute input
             "constant_cols": [
                 "elev_mean",
@@ -251,6 +255,7 @@ def cmd(
     c_rm_nan=1,
     var_t=None,
     t_rm_nan=1,
+    t_chunks=None,
     n_output=None,
     loss_func=None,
     model_param=None,
@@ -503,6 +508,13 @@ def cmd(
         default=t_rm_nan,
         type=int,
     )
+    parser.add_argument(
+        "--t_chunks",
+        dest="t_chunks",
+        help='chunks of var_t data such as {"basin": 100}; if set, var_t data are read lazily by dask',
+        default=t_chunks,
+        type=json.loads,
+    )
     parser.add_argument(
         "--var_t_type",
         dest="var_t_type",
@@ -774,6 +786,8 @@ def update_cfg(cfg_file, new_args):
         cfg_file["data_params"]["relevant_rm_nan"] = False
     else:
         cfg_file["data_params"]["relevant_rm_nan"] = True
+    if new_args.t_chunks is not None:
+        cfg_file["data_params"]["relevant_chunks"] = new_args.t_chunks
     if new_args.var_o is not None:
         cfg_file["data_params"]["other_cols"] = new_args.var_o
     if new_args.var_out is not None:
@@ -1,10 +1,12 @@
-import copy
+import hashlib
 import json
 import os
 import pickle as pkl
-import shutil
+import warnings
+from functools import cached_property
 import pint_xarray  # noqa: F401
 import xarray as xr
+from joblib import Memory, Parallel, delayed
 from hydrodataset import HydroDataset
 import numpy as np
 from sklearn.preprocessing import (
@@ -14,15 +16,10 @@ from sklearn.preprocessing import (
     MaxAbsScaler,
 )
 
-from hydroutils.hydro_stat import (
-    cal_stat_prcp_norm,
-    cal_stat_gamma,
-    cal_stat,
-)
-
 from torchhydro.datasets.data_utils import (
     _trans_norm,
     _prcp_norm,
+    _stat_arr,
     wrap_t_s_dict,
     unify_streamflow_unit,
 )
@@ -35,6 +32,293 @@ SCALER_DICT = {
 }
 
 
+def _log_sqrt(x: np.array) -> np.array:
+    """log(sqrt(x)+.1) transformation for gamma_norm_cols and prcp_norm_cols"""
+    return np.log10(np.sqrt(x) + 0.1)
+
+
+def _cols_mask(var_lst: list, chosen_cols: frozenset) -> np.array:
+    """boolean mask of var_lst showing which variables are in chosen_cols"""
+    return np.array([var in chosen_cols for var in var_lst], dtype=bool)
+
+
+def _flat_view(x: np.array) -> np.array:
+    """var_num*n view (a copy only if x is not contiguous) of data whose first axis is variable"""
+    return x.reshape(x.shape[0], -1)
+
+
+def _cal_stat_batch(x: np.array) -> np.array:
+    """
+    Calculate statistics of many variables in one pass
+
+    It is same as cal_stat in hydroutils, but x is var_num*n,
+    so all variables are reduced together rather than in a Python loop
+
+    Parameters
+    ----------
+    x
+        data whose first axis is variable and second axis is all values of the variable
+
+    Returns
+    -------
+    np.array
+        var_num*4 array; for each variable: [p10, p90, mean, std]
+    """
+    with warnings.catch_warnings():
+        # all-NaN variables are handled below
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        p10, p90 = np.nanpercentile(x, [10, 90], axis=1)
+        # data may be float32, but accumulate in float64 to keep statistics precise
+        mean = np.nanmean(x, axis=1, dtype=np.float64)
+        std = np.nanstd(x, axis=1, dtype=np.float64)
+    # if a variable has no valid value, give it a 0 value
+    empty = np.isnan(mean)
+    p10[empty] = 0.0
+    p90[empty] = 0.0
+    mean[empty] = 0.0
+    std[empty | (std < 0.001)] = 1.0
+    return np.stack([p10, p90, mean, std], axis=-1)
+
+
+def _cal_stat_group(x: np.array, gamma_mask: np.array) -> np.array:
+    """
+    Calculate statistics of a group of variables, some of which are gamma-distributed
+
+    Parameters
+    ----------
+    x
+        var_num*n data
+    gamma_mask
+        which variables use log(sqrt(x)+.1) transformation before calculating statistics
+
+    Returns
+    -------
+    np.array
+        var_num*4 array; for each variable: [p10, p90, mean, std]
+    """
+    if not gamma_mask.any():
+        # no selection, so no copy
+        return _cal_stat_batch(x)
+    stat_arr = np.empty((x.shape[0], 4))
+    stat_arr[gamma_mask] = _cal_stat_batch(_log_sqrt(x[gamma_mask]))
+    if not gamma_mask.all():
+        stat_arr[~gamma_mask] = _cal_stat_batch(x[~gamma_mask])
+    return stat_arr
+
+
+def _save_scaler(scaler, save_file: str):
+    """
+    Save fitted parameters of a sklearn scaler as NumPy arrays rather than pickling the scaler
+
+    Parameters
+    ----------
+    scaler
+        a fitted scaler in SCALER_DICT
+    save_file
+        the .npz file
+    """
+    params = {
+        k: v for k, v in vars(scaler).items() if k.endswith("_") and v is not None
+    }
+    np.savez(save_file, **params)
+
+
+def _load_scaler(scaler_type: str, save_file: str):
+    """
+    Recover a fitted sklearn scaler from parameters saved by _save_scaler
+
+    Parameters
+    ----------
+    scaler_type
+        key in SCALER_DICT
+    save_file
+        the .npz file
+
+    Returns
+    -------
+    the fitted scaler
+    """
+    scaler = SCALER_DICT[scaler_type]()
+    with np.load(save_file) as params:
+        for k in params.files:
+            value = params[k]
+            setattr(scaler, k, value[()] if value.ndim == 0 else value)
+    return scaler
+
+
+def _scaler_affine(scaler_type: str, params) -> tuple:
+    """
+    Parameters of a fitted scaler in SCALER_DICT in the form of (x - center) / scale
+
+    With them, we could normalize data directly without sklearn's validation and copy in transform
+
+    Parameters
+    ----------
+    scaler_type
+        key in SCALER_DICT
+    params
+        fitted parameters of the scaler: vars(scaler) or the lazily-loaded .npz saved by _save_scaler
+
+    Returns
+    -------
+    tuple
+        center and scale, each with one value for each feature
+    """
+    if scaler_type == "MinMaxScaler":
+        # x * scale_ + min_
+        return -params["min_"] / params["scale_"], 1.0 / params["scale_"]
+    if scaler_type == "StandardScaler":
+        center = params.get("mean_")
+    elif scaler_type == "RobustScaler":
+        center = params.get("center_")
+    else:
+        # MaxAbsScaler has no center
+        center = None
+    scale = params.get("scale_")
+    return (
+        0.0 if center is None else center,
+        1.0 if scale is None else scale,
+    )
+
+
+def _check_n_features(params, n_var: int, save_file: str):
+    """
+    Make sure a saved scaler was fitted with one feature for each variable
+
+    Scalers pickled by older versions were fitted with time steps (basins for attributes) as features,
+    so their parameters can't be broadcast along the variable axis
+
+    Parameters
+    ----------
+    params
+        fitted parameters of the scaler: vars(scaler) or the lazily-loaded .npz saved by _save_scaler
+    n_var
+        number of variables of the data to be normalized
+    save_file
+        the file of the scaler, only for the error message
+    """
+    n_features = int(params["n_features_in_"])
+    if n_features != n_var:
+        raise ValueError(
+            f"The scaler in {save_file} was fitted with {n_features} features, but the data have {n_var} variables. "
+            "Scalers saved by older versions used time steps (basins for attributes) as features; "
+            "please train the model again to fit a new scaler"
+        )
+
+
+def _data_hash(data: np.array) -> str:
+    """
+    A content hash of an array
+
+    joblib.Memory hashes arguments by pickling them, which is slow for large arrays,
+    so we hash the raw buffer with blake2b and give joblib only the digest
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{data.dtype.str}{data.shape}".encode())
+    h.update(np.ascontiguousarray(data).data)
+    return h.hexdigest()
+
+
+def _fit_scaler(data_hash: str, scaler_type: str, data: np.array):
+    """
+    Fit a scaler in SCALER_DICT
+
+    Parameters
+    ----------
+    data_hash
+        content hash of data; it is the cache key of data when this function is cached by joblib.Memory
+    scaler_type
+        key in SCALER_DICT
+    data
+        2-d data; it is ignored by joblib.Memory
+
+    Returns
+    -------
+    the fitted scaler
+    """
+    return SCALER_DICT[scaler_type]().fit(data)
+
+
+def _fit_or_transform(
+    data: xr.DataArray,
+    norm_key: str,
+    scaler_type: str,
+    data_params: dict,
+    loader_type: str,
+    memory: Memory = None,
+) -> tuple:
+    """
+    Fit a scaler in SCALER_DICT for training data or load it for valid/test data, then normalize data
+
+    Parameters
+    ----------
+    data
+        data to be normalized
+    norm_key
+        target_vars, relevant_vars or constant_vars
+    scaler_type
+        key in SCALER_DICT
+    data_params
+        parameters for reading data
+    loader_type
+        train, valid or test
+    memory
+        if not None, fitted scalers are cached in it, so the same training data is fitted only once
+
+    Returns
+    -------
+    tuple
+        normalized data and the scaler (for valid/test, it is None except for target_vars)
+    """
+    # put variable axis at last, so that it is the feature axis of sklearn's scaler
+    data_tmp = data.transpose(..., "variable")
+    values = data_tmp.to_numpy()
+    save_file = os.path.join(data_params["test_path"], f"{norm_key}_scaler.npz")
+    if loader_type == "train" and data_params["stat_dict_file"] is None:
+        # sklearn only fits 2-d data; values are not contiguous after the transpose,
+        # so for forcings and outputs this reshape is a copy
+        values_2d = values.reshape(-1, values.shape[-1])
+        if memory is None:
+            scaler = _fit_scaler(None, scaler_type, values_2d)
+        else:
+            scaler = memory.cache(_fit_scaler, ignore=["data"])(
+                _data_hash(values_2d), scaler_type, values_2d
+            )
+        # Save scaler's parameters in test_path for valid/test
+        _save_scaler(scaler, save_file)
+        center, scale = _scaler_affine(scaler_type, vars(scaler))
+    else:
+        if data_params["stat_dict_file"] is not None:
+            # read the assigned file directly rather than copying it to test_path
+            save_file = data_params["stat_dict_file"]
+        elif not os.path.isfile(save_file):
+            # experiments trained before scalers were saved as .npz have pickled scalers
+            save_file = os.path.splitext(save_file)[0] + ".pkl"
+        if not os.path.isfile(save_file):
+            raise FileNotFoundError("Please genereate xx_scaler.npz file")
+        if save_file.endswith(".pkl"):
+            with open(save_file, "rb") as infile:
+                scaler = pkl.load(infile)
+            _check_n_features(vars(scaler), values.shape[-1], save_file)
+            center, scale = _scaler_affine(scaler_type, vars(scaler))
+        else:
+            # members of a .npz can't be memory-mapped, but they are read lazily,
+            # so only read what normalization needs, and recover the scaler only for targets
+            with np.load(save_file) as params:
+                _check_n_features(params, values.shape[-1], save_file)
+                center, scale = _scaler_affine(scaler_type, params)
+            scaler = (
+                _load_scaler(scaler_type, save_file)
+                if norm_key == "target_vars"
+                else None
+            )
+    # normalized data is float32 for DL models; broadcast along the last (variable) axis
+    data_norm = values.astype(np.float32)
+    data_norm -= np.asarray(center, dtype=np.float32)
+    data_norm /= np.asarray(scale, dtype=np.float32)
+    return data_tmp.copy(data=data_norm).transpose(*data.dims), scaler
+
+
 class ScalerHub(object):
     """
     A class for Scaler
@@ -47,6 +331,7 @@ class ScalerHub(object):
         constant_vars: np.array = None,
         data_params: dict = None,
         loader_type: str = None,
+        memory: Memory = None,
         **kwargs,
     ):
         """
@@ -66,6 +351,9 @@ class ScalerHub(object):
             parameters for reading data
         loader_type
             train, valid or test
+        memory
+            a joblib.Memory to cache fitted scalers of SCALER_DICT, useful when the same training data
+            is normalized again and again, such as in cross validation or grid search
         kwargs
             other optional parameters for ScalerHub
         """
@@ -94,54 +382,21 @@ class ScalerHub(object):
         elif scaler_type in SCALER_DICT.keys():
             # TODO: not fully tested, espacially for pbm models
             all_vars = [target_vars, relevant_vars, constant_vars]
+            # the three groups are independent; NumPy releases the GIL, so threads are enough
+            results = Parallel(n_jobs=len(all_vars), prefer="threads")(
+                delayed(_fit_or_transform)(
+                    all_vars[i],
+                    norm_keys[i],
+                    scaler_type,
+                    data_params,
+                    loader_type,
+                    memory=memory,
+                )
+                for i in range(len(all_vars))
+            )
             for i in range(len(all_vars)):
-                data_tmp = all_vars[i]
-                scaler = SCALER_DICT[scaler_type]()
-                if data_tmp.ndim == 3:
-                    # for forcings and outputs
-                    num_instances, num_time_steps, num_features = data_tmp.shape
-                    data_tmp = data_tmp.to_numpy().reshape(-1, num_features)
-                    save_file = os.path.join(
-                        data_params["test_path"], f"{norm_keys[i]}_scaler.pkl"
-                    )
-                    if loader_type == "train" and data_params["stat_dict_file"] is None:
-                        data_norm = scaler.fit_transform(data_tmp)
-                        # Save scaler in test_path for valid/test
-                        with open(save_file, "wb") as outfile:
-                            pkl.dump(scaler, outfile)
-                    else:
-                        if data_params["stat_dict_file"] is not None:
-                            shutil.copy(data_params["stat_dict_file"], save_file)
-                        if not os.path.isfile(save_file):
-                            raise FileNotFoundError(
-                                "Please genereate xx_scaler.pkl file"
-                            )
-                        with open(save_file, "rb") as infile:
-                            scaler = pkl.load(infile)
-                            data_norm = scaler.transform(data_tmp)
-                    data_norm = data_norm.reshape(
-                        num_instances, num_time_steps, num_features
-                    )
-                else:
-                    # for attributes
-                    save_file = os.path.join(
-                        data_params["test_path"], f"{norm_keys[i]}_scaler.pkl"
-                    )
-                    if loader_type == "train" and data_params["stat_dict_file"] is None:
-                        data_norm = scaler.fit_transform(data_tmp)
-                        # Save scaler in test_path for valid/test
-                        with open(save_file, "wb") as outfile:
-                            pkl.dump(scaler, outfile)
-                    else:
-                        if data_params["stat_dict_file"] is not None:
-                            shutil.copy(data_params["stat_dict_file"], save_file)
-                        assert os.path.isfile(save_file)
-                        with open(save_file, "rb") as infile:
-                            scaler = pkl.load(infile)
-                            data_norm = scaler.transform(data_tmp)
-                norm_dict[norm_keys[i]] = data_norm
-                if i == 0:
-                    self.target_scaler = scaler
+                norm_dict[norm_keys[i]] = results[i][0]
+            self.target_scaler = results[0][1]
             x = norm_dict["relevant_vars"]
             y = norm_dict["target_vars"]
             c = norm_dict["constant_vars"]
@@ -155,6 +410,27 @@ class ScalerHub(object):
         self.c = c
 
 
+def _load_stat_dict(stat_file: str) -> dict:
+    """
+    Load stat_dict of DapengScaler
+
+    Parameters
+    ----------
+    stat_file
+        a .npz file, or a .json file saved by older versions
+
+    Returns
+    -------
+    dict
+        statistics of all variables
+    """
+    if stat_file.endswith(".json"):
+        with open(stat_file, "r") as fp:
+            return json.load(fp)
+    with np.load(stat_file) as stats:
+        return {var: stats[var] for var in stats.files}
+
+
 class DapengScaler(object):
     def __init__(
         self,
@@ -209,33 +485,92 @@ class DapengScaler(object):
                 "potential_evaporation",
                 "PET",
             ]
-        self.data_target = target_vars
-        self.data_forcing = relevant_vars
-        self.data_attr = constant_vars
+        # DL models consume float32 data, and it halves the memory traffic of normalization
+        self.data_target = target_vars.astype(np.float32, copy=False)
+        self.data_forcing = relevant_vars.astype(np.float32, copy=False)
+        self.data_attr = (
+            None
+            if constant_vars is None
+            else constant_vars.astype(np.float32, copy=False)
+        )
         self.data_source = data_source
         self.data_params = data_params
         self.t_s_dict = wrap_t_s_dict(data_source, data_params, loader_type)
         self.data_other = other_vars
-        self.prcp_norm_cols = prcp_norm_cols
-        self.gamma_norm_cols = gamma_norm_cols
+        # frozensets for fast membership tests
+        self.prcp_norm_cols = frozenset(prcp_norm_cols)
+        self.gamma_norm_cols = frozenset(gamma_norm_cols)
         # both prcp_norm_cols and gamma_norm_cols use log(\sqrt(x)+.1) method to normalize
-        self.log_norm_cols = gamma_norm_cols + prcp_norm_cols
+        self.log_norm_cols = self.gamma_norm_cols | self.prcp_norm_cols
+        # target_cols don't change, so find prcp_norm_cols in them only once
+        self._prcp_norm_target_idx = [
+            i
+            for i, var in enumerate(data_params["target_cols"])
+            if var in self.prcp_norm_cols
+        ]
+        self._prcp_norm_target_vars = [
+            data_params["target_cols"][i] for i in self._prcp_norm_target_idx
+        ]
         self.pbm_norm = pbm_norm
         # save stat_dict of training period in test_path for valid/test
-        stat_file = os.path.join(data_params["test_path"], "dapengscaler_stat.json")
+        stat_file = os.path.join(data_params["test_path"], "dapengscaler_stat.npz")
         # for testing sometimes such as pub cases, we need stat_dict_file from trained dataset
         if loader_type == "train" and data_params["stat_dict_file"] is None:
             self.stat_dict = self.cal_stat_all()
-            with open(stat_file, "w") as fp:
-                json.dump(self.stat_dict, fp)
+            np.savez(stat_file, **self.stat_dict)
         else:
             # for valid/test, we need to load stat_dict from train
             if data_params["stat_dict_file"] is not None:
-                # we used a assigned stat file, typically for PUB exps
-                shutil.copy(data_params["stat_dict_file"], stat_file)
+                # we used a assigned stat file, typically for PUB exps;
+                # read it directly rather than copying it to test_path in every run
+                stat_file = data_params["stat_dict_file"]
+            elif not os.path.isfile(stat_file):
+                # stat_dict saved by older versions is a json file
+                stat_file = os.path.splitext(stat_file)[0] + ".json"
             assert os.path.isfile(stat_file)
-            with open(stat_file, "r") as fp:
-                self.stat_dict = json.load(fp)
+            self.stat_dict = _load_stat_dict(stat_file)
+        # pack means and stds of each group once, so that we don't look up stat_dict in each normalization
+        self._stat_arr = {
+            cols: _stat_arr(self.stat_dict, data_params[cols])
+            for cols in ["target_cols", "relevant_cols", "constant_cols"]
+        }
+
+    @cached_property
+    def mean_prcp(self) -> np.array:
+        """basins' mean precipitation (basin_num*1); it is static, so read it only once"""
+        return (
+            self.data_source.read_mean_prcp(self.t_s_dict["sites_id"])
+            .to_array()
+            .to_numpy()
+            .T
+        )
+
+    @cached_property
+    def area(self) -> xr.Dataset:
+        """basins' area; it is static, so read it only once"""
+        return self.data_source.read_area(self.t_s_dict["sites_id"])
+
+    @cached_property
+    def _streamflow_factor(self) -> np.array:
+        """
+        Factors (one for each basin) to convert streamflow from its unit (typically mm/day) to m^3/s
+
+        The unit conversion is invariant, so we only run pint on one value for each basin
+        """
+        var = self.data_params["target_cols"][0]
+        sites = self.t_s_dict["sites_id"]
+        ones = xr.Dataset(
+            {
+                var: (
+                    "basin",
+                    np.ones(len(sites)),
+                    {"units": self.data_target.attrs["units"][var]},
+                )
+            },
+            coords={"basin": sites},
+        )
+        factor = unify_streamflow_unit(ones, area=self.area, inverse=True)
+        return factor[var].sel(basin=sites).to_numpy()
 
     def inverse_transform(self, target_values):
         """
@@ -248,8 +583,8 @@ class DapengScaler(object):
 
         Returns
         -------
-        np.array
-            denormalized predictions
+        xr.Dataset
+            denormalized predictions; streamflow's unit is m^3/s
         """
         stat_dict = self.stat_dict
         target_cols = self.data_params["target_cols"]
@@ -257,36 +592,30 @@ class DapengScaler(object):
             # for pbm's output, its unit is mm/day, so we don't need to recover its unit
             pred = target_values
         else:
+            # prcp_norm_cols are denormalized by mean precipitation in the same pass
             pred = _trans_norm(
                 target_values,
                 target_cols,
                 stat_dict,
                 log_norm_cols=self.log_norm_cols,
                 to_norm=False,
+                stat_arr=self._stat_arr["target_cols"],
+                prcp_norm_cols=self.prcp_norm_cols,
+                mean_prep=self.mean_prcp if self._prcp_norm_target_idx else None,
             )
-            for i in range(len(self.data_params["target_cols"])):
-                var = self.data_params["target_cols"][i]
-                if var in self.prcp_norm_cols:
-                    mean_prep = self.data_source.read_mean_prcp(
-                        self.t_s_dict["sites_id"]
-                    )
-                    pred.loc[dict(variable=var)] = _prcp_norm(
-                        pred.sel(variable=var).to_numpy(),
-                        mean_prep.to_array().to_numpy().T,
-                        to_norm=False,
-                    )
-        # add attrs for units
-        pred.attrs.update(self.data_target.attrs)
-        # trans to xarray dataset
-        pred_ds = pred.to_dataset(dim="variable")
-        pred_ds = pred_ds.pint.quantify(pred_ds.attrs["units"])
-        area = self.data_source.read_area(self.t_s_dict["sites_id"])
-        return unify_streamflow_unit(pred_ds, area=area, inverse=True)
+        # recover the unit of streamflow with precomputed factors rather than quantifying by pint each time
+        var = target_cols[0]
+        flow = pred.sel(variable=var).drop_vars("variable").transpose("basin", "time")
+        flow = flow * self._streamflow_factor[:, np.newaxis]
+        flow.attrs = {"units": "m^3/s"}
+        return flow.to_dataset(name=var)
 
     def cal_stat_all(self):
         """
         Calculate statistics of outputs(streamflow etc), and inputs(forcing and attributes)
 
+        All variables of one group are reduced together, so we don't need to loop over variables
+
         Returns
         -------
         dict
@@ -294,38 +623,40 @@ class DapengScaler(object):
         """
         # streamflow
         target_cols = self.data_params["target_cols"]
-        stat_dict = {}
-        for i in range(len(target_cols)):
-            var = target_cols[i]
-            if var in self.prcp_norm_cols:
-                mean_prep = self.data_source.read_mean_prcp(self.t_s_dict["sites_id"])
-                stat_dict[var] = cal_stat_prcp_norm(
-                    self.data_target.sel(variable=var).to_numpy(),
-                    mean_prep.to_array().to_numpy().T,
-                )
-            elif var in self.gamma_norm_cols:
-                stat_dict[var] = cal_stat_gamma(
-                    self.data_target.sel(variable=var).to_numpy()
-                )
-            else:
-                stat_dict[var] = cal_stat(self.data_target.sel(variable=var).to_numpy())
+        y = self.data_target.transpose("variable", ...).to_numpy()
+        prcp_idx = self._prcp_norm_target_idx
+        gamma_mask = _cols_mask(target_cols, self.gamma_norm_cols)
+        gamma_mask[prcp_idx] = True
+        if prcp_idx:
+            # prcp_norm_cols are divided by mean precipitation, so they can't be a view of data
+            y = y.copy()
+            y[prcp_idx] = y[prcp_idx] / self.mean_prcp
+        stat_arr = _cal_stat_group(_flat_view(y), gamma_mask)
+        stat_dict = {var: stat_arr[i] for i, var in enumerate(target_cols)}
 
         # forcing
         forcing_lst = self.data_params["relevant_cols"]
-        x = self.data_forcing
-        for k in range(len(forcing_lst)):
-            var = forcing_lst[k]
-            if var in self.gamma_norm_cols:
-                stat_dict[var] = cal_stat_gamma(x.sel(variable=var).to_numpy())
-            else:
-                stat_dict[var] = cal_stat(x.sel(variable=var).to_numpy())
+        x = self.data_forcing.transpose("variable", ...)
+        gamma_mask = _cols_mask(forcing_lst, self.gamma_norm_cols)
+        if x.chunks is None:
+            stat_arr = _cal_stat_group(_flat_view(x.to_numpy()), gamma_mask)
+        else:
+            # dask-backed data are loaded one variable at a time to limit peak memory
+            stat_arr = np.concatenate(
+                [
+                    _cal_stat_group(
+                        _flat_view(x[i : i + 1].to_numpy()), gamma_mask[i : i + 1]
+                    )
+                    for i in range(len(forcing_lst))
+                ]
+            )
+        stat_dict.update({var: stat_arr[i] for i, var in enumerate(forcing_lst)})
 
         # const attribute
-        attr_data = self.data_attr
         attr_lst = self.data_params["constant_cols"]
-        for k in range(len(attr_lst)):
-            var = attr_lst[k]
-            stat_dict[var] = cal_stat(attr_data.sel(variable=var).to_numpy())
+        attr_data = self.data_attr.transpose("variable", ...).to_numpy()
+        stat_arr = _cal_stat_batch(_flat_view(attr_data))
+        stat_dict.update({var: stat_arr[i] for i, var in enumerate(attr_lst)})
 
         return stat_dict
 
@@ -346,27 +677,28 @@ class DapengScaler(object):
             the output value for modeling
         """
         stat_dict = self.stat_dict
-        data = self.data_target
-        out = xr.full_like(data, np.nan)
-        # if we don't set a copy() here, the attrs of data will be changed, which is not our wish
-        out.attrs = copy.deepcopy(data.attrs)
+        data = self.data_target.transpose("variable", ...)
         target_cols = self.data_params["target_cols"]
-        for i in range(len(target_cols)):
-            var = target_cols[i]
-            if var in self.prcp_norm_cols:
-                mean_prep = self.data_source.read_mean_prcp(self.t_s_dict["sites_id"])
-                out.loc[dict(variable=var)] = _prcp_norm(
-                    data.sel(variable=var).to_numpy(),
-                    mean_prep.to_array().to_numpy().T,
-                    to_norm=True,
-                )
-                out.attrs["units"][var] = "dimensionless"
+        values = data.to_numpy().copy()
+        prcp_idx = self._prcp_norm_target_idx
+        # if we don't set a copy() here, the attrs of data will be changed, which is not our wish;
+        # only units are modified, so a shallow copy with a copied units dict is enough
+        attrs = dict(data.attrs)
+        attrs["units"] = dict(data.attrs.get("units", {}))
+        if prcp_idx:
+            values[prcp_idx] = _prcp_norm(
+                values[prcp_idx], self.mean_prcp, to_norm=True
+            )
+            for var in self._prcp_norm_target_vars:
+                attrs["units"][var] = "dimensionless"
+        out = xr.DataArray(values, coords=data.coords, dims=data.dims, attrs=attrs)
         out = _trans_norm(
             out,
             target_cols,
             stat_dict,
             log_norm_cols=self.log_norm_cols,
             to_norm=to_norm,
+            stat_arr=self._stat_arr["target_cols"],
         )
         return out
 
@@ -390,7 +722,12 @@ class DapengScaler(object):
         var_lst = self.data_params["relevant_cols"]
         data = self.data_forcing
         data = _trans_norm(
-            data, var_lst, stat_dict, log_norm_cols=self.log_norm_cols, to_norm=to_norm
+            data,
+            var_lst,
+            stat_dict,
+            log_norm_cols=self.log_norm_cols,
+            to_norm=to_norm,
+            stat_arr=self._stat_arr["relevant_cols"],
         )
         return data
 
@@ -413,7 +750,13 @@ class DapengScaler(object):
         stat_dict = self.stat_dict
         var_lst = self.data_params["constant_cols"]
         data = self.data_attr
-        data = _trans_norm(data, var_lst, stat_dict, to_norm=to_norm)
+        data = _trans_norm(
+            data,
+            var_lst,
+            stat_dict,
+            to_norm=to_norm,
+            stat_arr=self._stat_arr["constant_cols"],
+        )
         return data
 
     def load_data(self):
@@ -8,57 +8,82 @@ FilePath: /torchhydro/torchhydro/datasets/data_sets.py
 Copyright (c) 2021-2022 Wenyu Ouyang. All rights reserved.
 """
 import logging
-import sys
 from typing import Optional
 from torch.utils.data import RandomSampler
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import pint_xarray  # noqa: F401
 import torch
 import xarray as xr
 from hydrodataset import HydroDataset
+from numba import njit
 from torch.utils.data import Dataset
-from tqdm import tqdm
 from torchhydro.datasets.data_scalers import ScalerHub
 from torchhydro.datasets.data_utils import wrap_t_s_dict, unify_streamflow_unit
 
 LOGGER = logging.getLogger(__name__)
 
 
+def _to_numpy(data, dims: tuple) -> Optional[np.ndarray]:
+    """Materialize a DataArray (or Dataset) as a C-contiguous float32 array with the given dims order"""
+    if data is None:
+        return None
+    if isinstance(data, xr.Dataset):
+        data = data.to_array(dim="variable")
+    return np.ascontiguousarray(data.transpose(*dims).to_numpy(), dtype=np.float32)
+
+
+def _check_coords(ref: xr.DataArray, data, dims: tuple):
+    """Positions of ref's coords are used to index data, so data must have the same coords on dims"""
+    if data is None:
+        return
+    for dim in dims:
+        assert ref.indexes[dim].equals(
+            data.indexes[dim]
+        ), f"{dim} coords of the data don't match those of the target"
+
+
+# serial on purpose: it is only a copy, and it runs in DataLoader workers,
+# where a numba thread pool in each worker would oversubscribe the CPU
+@njit(cache=True)
+def _gather_batch(data, attr, basin_idx, start_idx, out):
+    """
+    out[k] = data[basin_idx[k], start_idx[k] : start_idx[k] + out.shape[1]],
+    followed by attr[basin_idx[k]] repeated along time in the last dim
+    """
+    n_var = data.shape[2]
+    for k in range(basin_idx.size):
+        b = basin_idx[k]
+        t0 = start_idx[k]
+        for t in range(out.shape[1]):
+            for j in range(n_var):
+                out[k, t, j] = data[b, t0 + t, j]
+            for j in range(attr.shape[1]):
+                out[k, t, n_var + j] = attr[b, j]
+
+
 def _fill_gaps_da(da: xr.DataArray, fill_nan: Optional[str] = None) -> xr.DataArray:
-    """Fill gaps in a DataArray"""
+    """Fill gaps in a DataArray; the input is not modified, a filled copy is returned"""
     if fill_nan is None or da is None:
         return da
     assert isinstance(da, xr.DataArray), "Expect da to be DataArray (not dataset)"
     # fill gaps
     if fill_nan == "et_ssm_ignore":
-        all_non_nan_idx = []
-        for i in range(da.shape[0]):
-            non_nan_idx_tmp = np.where(~np.isnan(da[i].values))
-            all_non_nan_idx = all_non_nan_idx + non_nan_idx_tmp[0].tolist()
-        # some NaN data appear in different dates in different basins
-        non_nan_idx = np.unique(all_non_nan_idx).tolist()
-        for i in range(da.shape[0]):
-            targ_i = da[i][non_nan_idx]
-            da[i][non_nan_idx] = targ_i.interpolate_na(
-                dim="time", fill_value="extrapolate"
-            )
+        # some NaN data appear in different dates in different basins,
+        # so keep every date that has a value in any basin
+        other_dims = [dim for dim in da.dims if dim != "time"]
+        non_nan_idx = np.flatnonzero(da.notnull().any(dim=other_dims).to_numpy())
+        filled = da.isel(time=non_nan_idx).interpolate_na(
+            dim="time", fill_value="extrapolate"
+        )
+        da = da.copy()
+        da[dict(time=non_nan_idx)] = filled
     elif fill_nan == "mean":
-        # fill with mean
-        for var in da["variable"].values:
-            var_data = da.sel(variable=var)  # select the data for the current variable
-            mean_val = var_data.mean(
-                dim="basin"
-            )  # calculate the mean across all basins
-            filled_data = var_data.fillna(
-                mean_val
-            )  # fill NaN values with the calculated mean
-            da.loc[
-                dict(variable=var)
-            ] = filled_data  # update the original dataarray with the filled data
+        # fill with the mean across all basins, for all variables at once
+        da = da.fillna(da.mean(dim="basin"))
     elif fill_nan == "interpolate":
-        # fill interpolation
-        for i in range(da.shape[0]):
-            da[i] = da[i].interpolate_na(dim="time", fill_value="extrapolate")
+        # interpolate_na works along time for all basins and variables in one call
+        da = da.interpolate_na(dim="time", fill_value="extrapolate")
     else:
         raise NotImplementedError(f"fill_nan {fill_nan} not implemented")
     return da
@@ -93,52 +118,71 @@ class BaseDataset(Dataset):
 
     def __getitem__(self, item: int):
         if not self.train_mode:
-            basin = self.t_s_dict["sites_id"][item]
+            basin_idx = self._basin_idx[self.t_s_dict["sites_id"][item]]
             # we don't need warmup_length for models yet
-            x = self.x.sel(basin=basin).to_numpy().T
-            y = self.y.sel(basin=basin).to_numpy().T
-            if self.c is None or self.c.shape[-1] == 0:
-                return torch.from_numpy(x).float(), torch.from_numpy(y).float()
             # TODO: not CHECK attributes reading
-            c = self.c.sel(basin=basin).values
-            c = np.repeat(c, x.shape[0], axis=0).reshape(c.shape[0], -1).T
-            xc = np.concatenate((x, c), axis=1)
-            return torch.from_numpy(xc).float(), torch.from_numpy(y).float()
-        basin, time = self.lookup_table[item]
+            xc = self._concat_attr(self.x[basin_idx], basin_idx)
+            return self._to_tensor(xc), self._to_tensor(self.y[basin_idx])
+        basin_idx = self.lookup_basin_idx[item]
+        time_idx = self.lookup_time_idx[item]
         seq_length = self.rho
         warmup_length = self.warmup_length
-        x = (
-            self.x.sel(
-                basin=basin,
-                time=slice(
-                    time - np.timedelta64(warmup_length, "D"),
-                    time + np.timedelta64(seq_length - 1, "D"),
-                ),
-            ).to_numpy()
-        ).T
-        if self.c is not None and self.c.shape[-1] > 0:
-            c = self.c.sel(basin=basin).values
-            c = np.tile(c, (warmup_length + seq_length, 1))
-            x = np.concatenate((x, c), axis=1)
+        x = self._concat_attr(
+            self.x[basin_idx, time_idx - warmup_length : time_idx + seq_length],
+            basin_idx,
+        )
         # for y, we don't need warmup as warmup are only used for get initial value for some state variables
-        y = (
-            self.y.sel(
-                basin=basin,
-                time=slice(
-                    time,
-                    time + np.timedelta64(seq_length - 1, "D"),
-                ),
-            )
-            .to_numpy()
-            .T
+        y = self.y[basin_idx, time_idx : time_idx + seq_length]
+        return self._to_tensor(x), self._to_tensor(y)
+
+    def __getitems__(self, indices):
+        """Fetch a whole mini-batch at once; DataLoader of torch>=2.0 uses it instead of __getitem__"""
+        if not self.train_mode:
+            return [self[i] for i in indices]
+        indices = np.asarray(indices)
+        basin_idx = self.lookup_basin_idx[indices]
+        time_idx = self.lookup_time_idx[indices]
+        x = self._gather(
+            self.x,
+            self._attr,
+            basin_idx,
+            time_idx - self.warmup_length,
+            self.warmup_length + self.rho,
+        )
+        y = self._gather(self.y, self._no_attr, basin_idx, time_idx, self.rho)
+        return list(zip(self._to_tensor(x), self._to_tensor(y)))
+
+    def _concat_attr(self, x: np.ndarray, basin_idx: int) -> np.ndarray:
+        """x (time, variable) followed by the basin's attributes repeated along time"""
+        if self.c is None or self.c.shape[-1] == 0:
+            return x
+        n_x = x.shape[-1]
+        # one new array is needed anyway, as the returned tensor shares its memory
+        xc = np.empty((x.shape[0], n_x + self.c.shape[-1]), dtype=np.float32)
+        xc[:, :n_x] = x
+        # broadcast along time
+        xc[:, n_x:] = self.c[basin_idx]
+        return xc
+
+    def _to_tensor(self, arr: np.ndarray) -> torch.Tensor:
+        """Wrap an array as a float32 tensor; zero-copy for float32 arrays"""
+        return torch.as_tensor(arr, dtype=torch.float32)
+
+    @staticmethod
+    def _gather(data, attr, basin_idx, start_idx, length):
+        out = np.empty(
+            (basin_idx.size, length, data.shape[2] + attr.shape[1]), dtype=np.float32
         )
-        return torch.from_numpy(x).float(), torch.from_numpy(y).float()
+        _gather_batch(data, attr, basin_idx, start_idx, out)
+        return out
 
     def _load_data(self):
         train_mode = self.loader_type == "train"
         self.t_s_dict = wrap_t_s_dict(
             self.data_source, self.data_params, self.loader_type
         )
+        # the reads stay sequential: readers of HydroDataset may write their netCDF cache
+        # when it is missing, and the real IO only happens later when data are converted
         # y
         data_flow_ds = self.data_source.read_ts_xrdataset(
             self.t_s_dict["sites_id"],
@@ -167,7 +211,13 @@ class BaseDataset(Dataset):
         else:
             data_flow = None
         if data_forcing_ds is not None:
-            data_forcing = self._trans2da_and_setunits(data_forcing_ds)
+            relevant_chunks = self.data_params["relevant_chunks"]
+            data_forcing = self._trans2da_and_setunits(
+                data_forcing_ds
+                if relevant_chunks is None
+                # dask-backed data are read chunk by chunk when they are computed
+                else data_forcing_ds.chunk(relevant_chunks)
+            )
         else:
             data_forcing = None
         if data_attr_ds is not None:
@@ -189,20 +239,62 @@ class BaseDataset(Dataset):
             data_source=self.data_source,
         )
 
-        self.x, self.y, self.c = self.kill_nan(scaler_hub.x, scaler_hub.c, scaler_hub.y)
+        x, y, c = self.kill_nan(scaler_hub.x, scaler_hub.c, scaler_hub.y)
+        # unnormalized data are indexed by the positions of y too (in DplDataset)
+        _check_coords(y, self.x_origin, ("basin", "time"))
+        _check_coords(y, self.y_origin, ("basin", "time"))
         self.train_mode = train_mode
         self.rho = self.data_params["forecast_history"]
         self.target_scaler = scaler_hub.target_scaler
         self.warmup_length = self.data_params["warmup_length"]
+        self._set_arrays(x, y, c)
+
+    def _set_arrays(self, x: xr.DataArray, y: xr.DataArray, c: xr.DataArray):
+        """
+        Keep normalized data as numpy arrays and create the lookup table of samples
+
+        train_mode, rho and warmup_length must be set before calling it
+
+        Parameters
+        ----------
+        x
+            normalized dynamic inputs with variable, basin and time dims
+        y
+            normalized outputs with variable, basin and time dims
+        c
+            normalized attributes with variable and basin dims; None if there is no attribute
+        """
+        # labels are dropped below, and rows and time positions of y are used for x and c
+        _check_coords(y, x, ("basin", "time"))
+        _check_coords(y, c, ("basin",))
+        # after normalization only plain numpy arrays (basin-first) are kept,
+        # so that __getitem__ only needs integer slicing
+        self.x = _to_numpy(x, ("basin", "time", "variable"))
+        self.y = _to_numpy(y, ("basin", "time", "variable"))
+        self.c = _to_numpy(c, ("basin", "variable"))
+        self._basin_idx = {basin: i for i, basin in enumerate(y["basin"].to_numpy())}
         self._create_lookup_table()
+        # attributes for _gather_batch; an empty one when there are no attributes
+        self._no_attr = np.empty((self.y.shape[0], 0), dtype=np.float32)
+        self._attr = self._no_attr if self.c is None else self.c
+        if self.train_mode and self.num_samples > 0:
+            # compile _gather_batch now rather than in the first mini-batch
+            self._gather(
+                self.y,
+                self._no_attr,
+                self.lookup_basin_idx[:1],
+                self.lookup_time_idx[:1],
+                1,
+            )
 
     def _trans2da_and_setunits(self, ds):
         """Set units for dataarray transfromed from dataset"""
         result = ds.to_array(dim="variable")
+        # data_vars skips the coordinates, which are not in the "variable" dim anyway
         units_dict = {
-            var: ds[var].attrs["units"]
-            for var in ds.variables
-            if "units" in ds[var].attrs
+            var: da.attrs["units"]
+            for var, da in ds.data_vars.items()
+            if "units" in da.attrs
         }
         result.attrs["units"] = units_dict
         return result
@@ -214,33 +306,31 @@ class BaseDataset(Dataset):
         c_rm_nan = data_params["constant_rm_nan"]
         if x_rm_nan:
             # As input, we cannot have NaN values
-            _fill_gaps_da(x, fill_nan="interpolate")
+            x = _fill_gaps_da(x, fill_nan="interpolate")
         if y_rm_nan:
-            _fill_gaps_da(y, fill_nan="interpolate")
+            y = _fill_gaps_da(y, fill_nan="interpolate")
         if c_rm_nan:
-            _fill_gaps_da(c, fill_nan="mean")
+            c = _fill_gaps_da(c, fill_nan="mean")
         return x, y, c
 
     def _create_lookup_table(self):
-        lookup = []
-        # list to collect basins ids of basins without a single training sample
-        basins = self.t_s_dict["sites_id"]
         rho = self.rho
         warmup_length = self.warmup_length
-        dates = self.y["time"].to_numpy()
-        time_length = len(dates)
-        for basin in tqdm(
-            basins, file=sys.stdout, disable=False, desc="Creating lookup table"
-        ):
-            # some dataloader load data with warmup period, so leave some periods for it
-            # [warmup_len] -> time_start -> [rho]
-            lookup.extend(
-                (basin, dates[f])
-                for f in range(warmup_length, time_length)
-                if f < time_length - rho + 1
-            )
-        self.lookup_table = dict(enumerate(lookup))
-        self.num_samples = len(self.lookup_table)
+        basin_num, time_length = self.y.shape[:2]
+        # a time step is valid if any target has a value on it
+        y_valid = ~np.isnan(self.y).all(axis=-1)
+        if time_length < rho:
+            window_valid = np.zeros((basin_num, 0), dtype=bool)
+        else:
+            # window_valid[b, t] tells whether y[b, t : t + rho] has any valid value
+            window_valid = sliding_window_view(y_valid, rho, axis=1).any(axis=-1)
+        # some dataloader load data with warmup period, so leave some periods for it
+        # [warmup_len] -> time_start -> [rho]; windows without any valid target are skipped
+        basin_idx, time_idx = np.nonzero(window_valid[:, warmup_length:])
+        # sample i starts at time lookup_time_idx[i] in basin row lookup_basin_idx[i]
+        self.lookup_basin_idx = basin_idx.astype(np.int32)
+        self.lookup_time_idx = (time_idx + warmup_length).astype(np.int32)
+        self.num_samples = self.lookup_basin_idx.size
 
 
 class BasinSingleFlowDataset(BaseDataset):
@@ -256,6 +346,10 @@ class BasinSingleFlowDataset(BaseDataset):
         y = ys[-1, :]
         return xc, y
 
+    def __getitems__(self, indices):
+        samples = super(BasinSingleFlowDataset, self).__getitems__(indices)
+        return [(xc, ys[-1, :]) for xc, ys in samples]
+
     def __len__(self):
         return self.num_samples
 
@@ -289,17 +383,12 @@ class KuaiSampler(RandomSampler):
         nt : int
             number of all periods
         """
-        while batch_size * rho >= ngrid * nt:
-            # try to use a smaller batch_size to make the model runnable
-            batch_size = int(batch_size / 10)
-        batch_size = max(batch_size, 1)
+        # the largest batch_size (no more than the given one) with batch_size * rho < ngrid * nt
+        batch_size = max(1, min(batch_size, (ngrid * nt - 1) // rho))
+        # fraction of all periods' data covered by one mini-batch
+        ratio = batch_size * rho / ngrid / (nt - warmup_length)
         # 99% chance that all periods' data are used in an epoch
-        n_iter_ep = int(
-            np.ceil(
-                np.log(0.01)
-                / np.log(1 - batch_size * rho / ngrid / (nt - warmup_length))
-            )
-        )
+        n_iter_ep = int(np.ceil(np.log(0.01) / np.log1p(-ratio)))
         assert n_iter_ep >= 1
         # __len__ means the number of all samples, then, the number of loops in an epoch is __len__()/batch_size = n_iter_ep
         # hence we return n_iter_ep * batch_size
@@ -327,6 +416,10 @@ class DplDataset(BaseDataset):
         self.warmup_length = data_params["warmup_length"]
         self.target_as_input = data_params["target_as_input"]
         self.constant_only = data_params["constant_only"]
+        # unnormalized data are converted once, here rather than in every __getitem__,
+        # and only for dPL as other datasets don't read them
+        self._x_origin_np = _to_numpy(self.x_origin, ("basin", "time", "variable"))
+        self._y_origin_np = _to_numpy(self.y_origin, ("basin", "time", "variable"))
         if self.target_as_input and (not self.train_mode):
             # if the target is used as input and train_mode is False,
             # we need to get the target data in training period to generate pbm params
@@ -353,86 +446,55 @@ class DplDataset(BaseDataset):
         """
         if self.train_mode:
             xc_norm, _ = super(DplDataset, self).__getitem__(item)
-            basin, time = self.lookup_table[item]
+            basin_idx = self.lookup_basin_idx[item]
+            time_idx = self.lookup_time_idx[item]
             warmup_length = self.warmup_length
             if self.target_as_input:
                 # y_morn and xc_norm are concatenated and used for DL model
-                y_norm = torch.from_numpy(
-                    self.y[basin, time - warmup_length : time + self.rho, :]
-                ).float()
+                y_norm = self._to_tensor(
+                    self.y[basin_idx, time_idx - warmup_length : time_idx + self.rho]
+                )
                 # the order of xc_norm and y_norm matters, please be careful!
                 z_train = torch.cat((xc_norm, y_norm), -1)
             elif self.constant_only:
                 # only use attributes data for DL model
-                z_train = torch.from_numpy(self.c[basin, :]).float()
+                z_train = self._to_tensor(self.c[basin_idx])
             else:
-                z_train = xc_norm.float()
-            x_train = (
-                self.x_origin.sel(
-                    basin=basin,
-                    time=slice(
-                        time - np.timedelta64(warmup_length, "D"),
-                        time + np.timedelta64(self.rho - 1, "D"),
-                    ),
-                )
-                .to_array()
-                .to_numpy()
-                .T
-            )
-            y_train = (
-                self.y_origin.sel(
-                    basin=basin,
-                    time=slice(
-                        time,
-                        time + np.timedelta64(self.rho - 1, "D"),
-                    ),
-                )
-                .to_array()
-                .to_numpy()
-                .T
-            )
+                z_train = xc_norm
+            x_train = self._x_origin_np[
+                basin_idx, time_idx - warmup_length : time_idx + self.rho
+            ]
+            y_train = self._y_origin_np[basin_idx, time_idx : time_idx + self.rho]
         else:
             basin = self.t_s_dict["sites_id"][item]
-            x_norm = self.x.sel(basin=basin).to_numpy().T
+            basin_idx = self._basin_idx[basin]
+            x_norm = self.x[basin_idx]
             if self.target_as_input:
                 # when target_as_input is True,
                 # we need to use training data to generate pbm params
-                x_norm = self.train_dataset.sel(basin=basin).to_numpy().T
-            if self.c is None or self.c.shape[-1] == 0:
-                xc_norm = torch.from_numpy(x_norm).float()
-            else:
-                c_norm = self.c.sel(basin=basin).values
-                c_norm = (
-                    np.repeat(c_norm, x_norm.shape[0], axis=0)
-                    .reshape(c_norm.shape[0], -1)
-                    .T
-                )
-                xc_norm = np.concatenate((x_norm, c_norm), axis=1)
+                train_basin_idx = self.train_dataset._basin_idx[basin]
+                x_norm = self.train_dataset.x[train_basin_idx]
+            xc_norm = self._to_tensor(self._concat_attr(x_norm, basin_idx))
             warmup_length = self.warmup_length
             if self.target_as_input:
                 # when target_as_input is True,
                 # we need to use training data to generate pbm params
                 # when used as input, warmup_length not included for y
-                y_norm = torch.from_numpy(self.train_dataset.y[item, :, :]).float()
+                y_norm = self._to_tensor(self.train_dataset.y[train_basin_idx])
                 # the order of xc_norm and y_norm matters, please be careful!
                 z_train = torch.cat((xc_norm, y_norm), -1)
             elif self.constant_only:
                 # only use attributes data for DL model
-                z_train = torch.from_numpy(self.c[item, :]).float()
+                z_train = self._to_tensor(self.c[basin_idx])
             else:
-                z_train = torch.from_numpy(xc_norm).float()
-            x_train = self.x_origin.sel(basin=basin).to_array().to_numpy().T
-            y_train = (
-                self.y_origin.sel(basin=basin)
-                .isel(time=slice(warmup_length, None))
-                .to_array()
-                .to_numpy()
-                .T
-            )
-        return (
-            torch.from_numpy(x_train).float(),
-            z_train,
-        ), torch.from_numpy(y_train).float()
+                z_train = xc_norm
+            x_train = self._x_origin_np[basin_idx]
+            y_train = self._y_origin_np[basin_idx, warmup_length:]
+        return (self._to_tensor(x_train), z_train), self._to_tensor(y_train)
+
+    def __getitems__(self, indices):
+        # dPL samples carry unnormalized data too, so fetch them one by one
+        return [self[i] for i in indices]
 
     def __len__(self):
         return self.num_samples if self.train_mode else len(self.t_s_dict["sites_id"])
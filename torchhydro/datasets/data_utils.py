@@ -7,12 +7,15 @@ Description: Some basic funtions for dealing with data
 FilePath: /torchhydro/torchhydro/datasets/data_utils.py
 Copyright (c) 2023-2024 Wenyu Ouyang. All rights reserved.
 """
+from functools import lru_cache
 from typing import Union
 from hydrodataset import HydroDataset
 from collections import OrderedDict
 import numpy as np
+import pandas as pd
 import xarray as xr
 import pint_xarray  # noqa: F401
+from numba import njit, prange
 
 
 def unify_streamflow_unit(ds: xr.Dataset, area=None, inverse=False):
@@ -80,12 +83,75 @@ def wrap_t_s_dict(
     return OrderedDict(sites_id=basins_id, t_final_range=t_range_list)
 
 
+def _stat_arr(stat_dict: dict, var_lst: list) -> np.array:
+    """
+    Pack means and stds of variables into one array
+
+    Parameters
+    ----------
+    stat_dict
+        statistics of all variables; for each variable: [p10, p90, mean, std]
+    var_lst
+        the chosen variables
+
+    Returns
+    -------
+    np.array
+        2*var_num array; the first row is mean and the second is std
+    """
+    return np.array(
+        [[stat_dict[var][2] for var in var_lst], [stat_dict[var][3] for var in var_lst]]
+    )
+
+
+@lru_cache(maxsize=16)
+def _norm_plan(
+    data_vars: tuple,
+    var_lst: tuple,
+    log_norm_cols: frozenset,
+    prcp_norm_cols: frozenset,
+) -> tuple:
+    """
+    Index vectors used by the normalization kernels in _trans_norm
+
+    The variables of a dataset don't change during training, so the plan is cached
+
+    Parameters
+    ----------
+    data_vars
+        variables of data, in the order of its variable axis
+    var_lst
+        variables to be normalized or denormalized
+    log_norm_cols
+        which cols use log(sqrt(x)+.1) norm method
+    prcp_norm_cols
+        which cols use _prcp_norm method
+
+    Returns
+    -------
+    tuple
+        rows of var_lst in data, and boolean masks of var_lst for log_norm_cols and prcp_norm_cols;
+        all are read-only as they are shared by all calls
+    """
+    rows = pd.Index(data_vars).get_indexer(var_lst)
+    if (rows < 0).any():
+        raise KeyError(f"{np.asarray(var_lst)[rows < 0]} not in data")
+    log_mask = np.array([item in log_norm_cols for item in var_lst], dtype=bool)
+    prcp_mask = np.array([item in prcp_norm_cols for item in var_lst], dtype=bool)
+    for arr in (rows, log_mask, prcp_mask):
+        arr.setflags(write=False)
+    return rows, log_mask, prcp_mask
+
+
 def _trans_norm(
     x: xr.DataArray,
     var_lst: list,
     stat_dict: dict,
-    log_norm_cols: list = None,
+    log_norm_cols: Union[list, frozenset] = None,
     to_norm: bool = True,
+    stat_arr: np.array = None,
+    prcp_norm_cols: Union[list, frozenset] = None,
+    mean_prep: np.array = None,
     **kwargs,
 ) -> np.array:
     """
@@ -104,7 +170,7 @@ def _trans_norm(
     Parameters
     ----------
     x
-        data to be normalized or denormalized
+        data to be normalized or denormalized; if it is dask-backed, the result is lazy too
     var_lst
         the type of variables
     stat_dict
@@ -113,11 +179,18 @@ def _trans_norm(
         which cols use the second norm method
     to_norm
         if true, normalize; else denormalize
+    stat_arr
+        means and stds of var_lst packed by _stat_arr; if None, we get them from stat_dict
+    prcp_norm_cols
+        only for denormalization; vars in it are also multiplied by mean_prep in the same pass,
+        i.e. the inversion of _prcp_norm is fused into this function
+    mean_prep
+        basins' mean precipitation (basin_num*1) for prcp_norm_cols; x must have basin and time dims then
 
     Returns
     -------
     np.array
-        normalized or denormalized data
+        normalized or denormalized data (float32)
     """
     if x is None:
         return None
@@ -125,21 +198,51 @@ def _trans_norm(
         log_norm_cols = []
     if type(var_lst) is str:
         var_lst = [var_lst]
-    out = xr.full_like(x, np.nan)
-    for item in var_lst:
-        stat = stat_dict[item]
-        if to_norm:
-            out.loc[dict(variable=item)] = (
-                (np.log10(np.sqrt(x.sel(variable=item)) + 0.1) - stat[2]) / stat[3]
-                if item in log_norm_cols
-                else (x.sel(variable=item) - stat[2]) / stat[3]
-            )
-        elif item in log_norm_cols:
-            out.loc[dict(variable=item)] = (
-                np.power(10, x.sel(variable=item) * stat[3] + stat[2]) - 0.1
-            ) ** 2
-        else:
-            out.loc[dict(variable=item)] = x.sel(variable=item) * stat[3] + stat[2]
+    if stat_arr is None:
+        stat_arr = _stat_arr(stat_dict, var_lst)
+    fuse_prcp_norm = mean_prep is not None
+    if fuse_prcp_norm and to_norm:
+        raise ValueError(
+            "mean_prep is only for denormalization; use _prcp_norm before normalizing"
+        )
+    # put variable axis first so that every variable is a contiguous block for the kernels
+    dims = ("variable", "basin", "time") if fuse_prcp_norm else ("variable", ...)
+    data = x.transpose(*dims)
+    rows, log_mask, prcp_mask = _norm_plan(
+        tuple(data.indexes["variable"]),
+        tuple(var_lst),
+        frozenset(log_norm_cols),
+        frozenset(prcp_norm_cols if fuse_prcp_norm else ()),
+    )
+    norm_kwargs = dict(
+        rows=rows,
+        mean=stat_arr[0],
+        std=stat_arr[1],
+        log_mask=log_mask,
+        to_norm=to_norm,
+    )
+    if fuse_prcp_norm:
+        values = np.ascontiguousarray(data.to_numpy(), dtype=np.float32)
+        out_values = np.full_like(values, np.nan)
+        _denorm_prcp_kernel(
+            values,
+            rows,
+            stat_arr[0],
+            stat_arr[1],
+            log_mask,
+            prcp_mask,
+            np.ascontiguousarray(mean_prep, dtype=np.float32).reshape(-1),
+            out_values,
+        )
+    elif data.chunks is not None:
+        # dask-backed data are normalized block by block and stay lazy,
+        # so only blocks (with all variables in each) are loaded when they are computed
+        out_values = data.data.rechunk({0: -1}).map_blocks(
+            _trans_norm_values, dtype=np.float32, parallel=False, **norm_kwargs
+        )
+    else:
+        out_values = _trans_norm_values(data.to_numpy(), **norm_kwargs)
+    out = data.copy(deep=False, data=out_values).transpose(*x.dims)
     if to_norm:
         # after normalization, all units are dimensionless
         out.attrs = {}
@@ -152,6 +255,125 @@ def _trans_norm(
     return out
 
 
+def _trans_norm_values(
+    values: np.array,
+    rows: np.array,
+    mean: np.array,
+    std: np.array,
+    log_mask: np.array,
+    to_norm: bool,
+    parallel: bool = True,
+) -> np.array:
+    """
+    Normalize or denormalize an array whose first axis is variable with _norm_kernel or _denorm_kernel
+
+    Parameters
+    ----------
+    values
+        data; the first axis is variable
+    rows
+        rows of the chosen variables in values
+    mean
+        means of the chosen variables
+    std
+        stds of the chosen variables
+    log_mask
+        which chosen variables use log(sqrt(x)+.1) norm method
+    to_norm
+        if true, normalize; else denormalize
+    parallel
+        if false, use the serial kernels; they are for blocks of dask, which are already run in threads
+
+    Returns
+    -------
+    np.array
+        float32 result; rows of variables not chosen are NaN
+    """
+    values = np.ascontiguousarray(values, dtype=np.float32)
+    out = np.full_like(values, np.nan)
+    if parallel:
+        kernel = _norm_kernel if to_norm else _denorm_kernel
+    else:
+        kernel = _norm_kernel_serial if to_norm else _denorm_kernel_serial
+    kernel(
+        values.reshape(values.shape[0], -1),
+        rows,
+        mean,
+        std,
+        log_mask,
+        out.reshape(values.shape[0], -1),
+    )
+    return out
+
+
+# NaN must survive the kernels as there are gaps in data, so "nnan" and "ninf" are not allowed
+_FASTMATH = {"contract", "afn", "arcp"}
+
+
+@njit(parallel=True, fastmath=_FASTMATH, error_model="numpy", cache=True)
+def _norm_kernel(x, rows, mean, std, log_mask, out):
+    """
+    out[rows[k]] = (x[rows[k]] - mean[k]) / std[k],
+    or [log_{10}(sqrt(x[rows[k]]) + 0.1) - mean[k]] / std[k] if log_mask[k]
+    """
+    for k in range(rows.size):
+        r = rows[k]
+        m = mean[k]
+        s = std[k]
+        if log_mask[k]:
+            for i in prange(x.shape[1]):
+                out[r, i] = (np.log10(np.sqrt(x[r, i]) + 0.1) - m) / s
+        else:
+            for i in prange(x.shape[1]):
+                out[r, i] = (x[r, i] - m) / s
+
+
+@njit(parallel=True, fastmath=_FASTMATH, error_model="numpy", cache=True)
+def _denorm_kernel(x, rows, mean, std, log_mask, out):
+    """inversion of _norm_kernel"""
+    for k in range(rows.size):
+        r = rows[k]
+        m = mean[k]
+        s = std[k]
+        if log_mask[k]:
+            for i in prange(x.shape[1]):
+                out[r, i] = (10.0 ** (x[r, i] * s + m) - 0.1) ** 2
+        else:
+            for i in prange(x.shape[1]):
+                out[r, i] = x[r, i] * s + m
+
+
+# numba's parallel kernels must not be launched from dask's threads, so blocks use serial builds;
+# they are not cached on disk as numba's cache can't tell them from the parallel builds of the same function
+_norm_kernel_serial = njit(fastmath=_FASTMATH, error_model="numpy")(
+    _norm_kernel.py_func
+)
+_denorm_kernel_serial = njit(fastmath=_FASTMATH, error_model="numpy")(
+    _denorm_kernel.py_func
+)
+
+
+@njit(parallel=True, fastmath=_FASTMATH, error_model="numpy", cache=True)
+def _denorm_prcp_kernel(x, rows, mean, std, log_mask, prcp_mask, mean_prep, out):
+    """
+    _denorm_kernel and denormalization of _prcp_norm in one pass over memory
+
+    x and out are var_num*basin_num*time_num; mean_prep has one value for each basin
+    """
+    for k in range(rows.size):
+        r = rows[k]
+        m = mean[k]
+        s = std[k]
+        for b in prange(x.shape[1]):
+            factor = mean_prep[b] if prcp_mask[k] else 1.0
+            if log_mask[k]:
+                for t in range(x.shape[2]):
+                    out[r, b, t] = (10.0 ** (x[r, b, t] * s + m) - 0.1) ** 2 * factor
+            else:
+                for t in range(x.shape[2]):
+                    out[r, b, t] = (x[r, b, t] * s + m) * factor
+
+
 def _prcp_norm(x: np.array, mean_prep: np.array, to_norm: bool) -> np.array:
     """
     Normalize or denormalize data with mean precipitation.
@@ -163,7 +385,7 @@ def _prcp_norm(x: np.array, mean_prep: np.array, to_norm: bool) -> np.array:
     Parameters
     ----------
     x
-        data to be normalized or denormalized
+        data to be normalized or denormalized; its last two axes are basin and time
     mean_prep
         basins' mean precipitation
     to_norm
@@ -174,8 +396,8 @@ def _prcp_norm(x: np.array, mean_prep: np.array, to_norm: bool) -> np.array:
     np.array
         normalized or denormalized data
     """
-    tempprep = np.tile(mean_prep, (1, x.shape[1]))
-    return x / tempprep if to_norm else x * tempprep
+    # mean_prep is basin_num*1, so it is broadcast along the time axis (the last one)
+    return x / mean_prep if to_norm else x * mean_prep
 
 
 def dor_reservoirs_chosen(gages, usgs_id, dor_chosen) -> list:
@@ -271,8 +271,8 @@ def get_train_valid_dataloader(forecast_model, training_params, data_params):
         batch_size = data_params["batch_size"]
         rho = data_params["forecast_history"]
         warmup_length = data_params["warmup_length"]
-        ngrid = train_dataset.y.basin.size
-        nt = train_dataset.y.time.size
+        # y of the dataset is a (basin, time, variable) array
+        ngrid, nt = train_dataset.y.shape[:2]
         sampler = KuaiSampler(
             train_dataset,
             batch_size=batch_size,
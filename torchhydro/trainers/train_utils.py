@@ -71,8 +71,7 @@ def denormalize4eval(validation_data_loader, output, labels):
         units = {**units, **target_data.attrs["units"]}
     # need to remove data in the warmup period
     warmup_length = validation_data_loader.dataset.warmup_length
-    selected_time_points = target_data.coords["time"][warmup_length:]
-    selected_data = target_data.sel(time=selected_time_points)
+    selected_data = target_data.isel(time=slice(warmup_length, None))
     preds_xr = target_scaler.inverse_transform(
         xr.DataArray(
             output.transpose(2, 0, 1),